@@ -3,12 +3,25 @@
 # Extract → Retrieve → Reason → Rename
 # ===========================================================
 
-import os, re, json, time, csv, glob
+import os, re, time, csv, glob, hashlib, pickle, shelve
+from concurrent.futures import ThreadPoolExecutor
 import numpy as np
+import orjson
 import requests
+from requests.adapters import HTTPAdapter
 from dotenv import load_dotenv
-from rdflib import Graph, Namespace, RDF, OWL, URIRef, Literal
+from rdflib import Graph, Namespace, OWL, URIRef, Literal
 from rdflib.namespace import PROV, XSD
+from rdflib.plugins.sparql import prepareQuery
+
+try:
+    import faiss  # optional: SIMD top-K search; falls back to a NumPy GEMM when missing
+except ImportError:
+    faiss = None
+try:
+    import torch  # optional: similarity search on CUDA / Apple MPS when a GPU is present
+except ImportError:
+    torch = None
 
 # ---------------- CONFIG ----------------
 load_dotenv()
@@ -21,18 +34,39 @@ if not AALTO_KEY:
 # 2) Otherwise it will auto-detect all OEM* files.
 TTL_FILES = None # None = auto-detect all OEM*_OEM.ttl; or set ["OEMA_OEM.ttl"]
 TOP_K = 5
+EMBED_BATCH = 64           # queries per embeddings request
+LLM_CONCURRENCY = 8        # reasoning calls in flight at once
 CONF_THRESHOLD = 0.5       # auto-accept confidence for renaming
+AUTO_ACCEPT_SIM = 0.5      # top-1 similarity needed to skip the LLM ...
+SIM_GAP = 0.06             # ... together with this margin over top-2
 SHACL_RULES = None         # set to "TRAFICOM_SHACL.ttl" when you want validation
 
 # --- Aalto API endpoints ---
 EMBED_URL = "https://aalto-openai-apigw.azure-api.net/v1/openai/text-embedding-3-large/embeddings"
 LLM_URL   = "https://aalto-openai-apigw.azure-api.net/v1/openai/deployments/gpt-4.1-2025-04-14/chat/completions"
+EMBED_MODEL = "text-embedding-3-large"
+LLM_MODEL   = "gpt-4.1-2025-04-14"
+PROMPT_VERSION = 1        # part of the reasoning-cache key: bump whenever reason_best_match's prompt changes
 HEADERS   = {"Content-Type": "application/json", "Ocp-Apim-Subscription-Key": AALTO_KEY}
 
+# one pooled keep-alive session for every Aalto call (avoids a TLS handshake per request)
+SESSION = requests.Session()
+SESSION.headers.update(HEADERS)
+SESSION.mount("https://", HTTPAdapter(pool_connections=4, pool_maxsize=16, max_retries=0))
+
 # --- ontology store (pre-embedded) ---
 ONTO_VECS = "ontology_vectors.npy"
 ONTO_IDS  = "ontology_ids.json"
 ONTO_TXTS = "ontology_texts.json"
+FAISS_IVF_MIN = 50_000                  # ontologies this large use an IVF index instead of flat search
+ONTO_QUANT = None                       # FAISS storage: None = float32, "fp16" (½ bytes) or "int8" (¼ bytes)
+
+# --- local caches (safe to delete): parsed TTLs by extractor version + file sha256, API responses by request hash ---
+CACHE_DIR = ".cache"
+EMBED_CACHE  = os.path.join(CACHE_DIR, "embed")    # shelve: (model, text) → vector
+REASON_CACHE = os.path.join(CACHE_DIR, "reason")   # shelve: (model, prompt version, var, query, candidate ids) → LLM result
+EXTRACT_VERSION = 1   # part of the parsed-TTL cache key: bump whenever extract_vars / VARS_QUERY output changes
+ONTO_INDEX   = os.path.join(CACHE_DIR, "ontology_vectors.{}.faiss")  # trained FAISS index per layout
 
 # --- namespaces ---
 sosa = Namespace("http://www.w3.org/ns/sosa/")
@@ -43,54 +77,180 @@ qudt = Namespace("http://qudt.org/2.1/schema/qudt#")
 prov = Namespace("http://www.w3.org/ns/prov#")
 owl  = OWL
 
+# all variable metadata of a TTL in a single query (ssp:* takes precedence over fmu:*)
+VARS_QUERY = prepareQuery("""
+SELECT ?s ?fmuName ?sspName ?ctx ?fmuType ?sspType ?unit ?val WHERE {
+    ?s a ?t .
+    FILTER(?t IN (sosa:ObservableProperty, ssn:Property))
+    OPTIONAL { ?s fmu:hasFMUVariableName ?fmuName }
+    OPTIONAL { ?s ssp:hasVariableName ?sspName }
+    OPTIONAL { ?s ssn:isPropertyOf ?ctx }
+    OPTIONAL { ?s fmu:hasDataType ?fmuType }
+    OPTIONAL { ?s ssp:hasDataType ?sspType }
+    OPTIONAL { ?s qudt:unit ?unit }
+    OPTIONAL { ?obs sosa:observedProperty ?s ; sosa:hasSimpleResult ?val }
+}
+""", initNs={"sosa": sosa, "ssn": ssn, "fmu": fmu, "ssp": ssp, "qudt": qudt})
+
 # ---------------- UTILITIES ----------------
-def embed_text_online(text, dim=3072, retries=3, sleep=5):
-    """Get an embedding from Aalto; robust retries; safe zero-vector fallback."""
-    payload = {"input": text, "model": "text-embedding-3-large"}
+def _embed_request(inputs, retries=3, sleep=5):
+    """(vectors, None) from one embeddings call over `inputs`, or (None, last HTTP status) once the retries
+    are spent; the status is None when the last attempt never got a response."""
+    status = None
     for attempt in range(1, retries + 1):
         try:
-            r = requests.post(EMBED_URL, headers=HEADERS, json=payload, timeout=45)
+            r = SESSION.post(EMBED_URL, json={"input": inputs, "model": EMBED_MODEL}, timeout=45)
+            status = r.status_code
             if r.status_code == 200:
-                data = r.json()["data"][0]["embedding"]
-                return np.array(data, dtype=np.float32)
+                data = sorted(orjson.loads(r.content)["data"], key=lambda d: d["index"])
+                return np.array([d["embedding"] for d in data], dtype=np.float32), None
             else:
                 print(f"  Embedding API error ({r.status_code}): {r.text[:180]}")
         except requests.exceptions.RequestException:
+            status = None
             print(f"  Embedding connection attempt {attempt} failed — check VPN/network.")
         if attempt < retries:
             time.sleep(sleep)
-    print("  Embedding API unreachable → using zero-vector fallback (results less reliable).")
-    return np.zeros(dim, dtype=np.float32)
-
-def cosine_similarity(vec, mat):
-    """Cosine similarity with NaN/Inf safety."""
-    denom = np.linalg.norm(vec)
-    if (denom == 0) or (not np.isfinite(denom)):
-        return np.zeros(mat.shape[0], dtype=np.float32)
-    v = vec / denom
-    Mnorms = np.linalg.norm(mat, axis=1, keepdims=True)
-    M = np.divide(mat, Mnorms, out=np.zeros_like(mat), where=(Mnorms != 0))
-    sims = M @ v
+    return None, status
+
+def embed_texts_online(texts, dim=3072, batch=EMBED_BATCH, retries=3, sleep=5):
+    """Embed a list of texts, `batch` inputs per request; robust retries. A batch the API keeps rejecting
+    is retried one text at a time (one bad input must not blank its neighbours); zero-vector fallback."""
+    out = np.zeros((len(texts), dim), dtype=np.float32)
+    for start in range(0, len(texts), batch):
+        chunk = texts[start:start + batch]
+        vecs, status = _embed_request(chunk, retries, sleep)
+        if vecs is not None:
+            out[start:start + len(chunk)] = vecs
+            continue
+        if status not in (None, 429) and len(chunk) > 1:
+            print(f"  Embedding batch rejected ({status}) → retrying its {len(chunk)} queries one by one.")
+            failed = 0
+            for i, text in enumerate(chunk):
+                vec, _ = _embed_request([text], retries, sleep)
+                if vec is None:
+                    failed += 1
+                else:
+                    out[start + i] = vec[0]
+        else:
+            failed = len(chunk)
+        if failed:
+            print(f"  Embedding API unreachable → zero-vector fallback for {failed} queries (results less reliable).")
+    return out
+
+def cache_key(*parts):
+    """Stable hash of a request's inputs, used as the shelve key."""
+    return hashlib.sha256(orjson.dumps(parts)).hexdigest()
+
+def embed_texts_cached(texts, db, dim=3072):
+    """embed_texts_online behind the persistent cache `db`; zero-vector fallbacks are never stored."""
+    keys = [cache_key(EMBED_MODEL, t) for t in texts]
+    out = np.zeros((len(texts), dim), dtype=np.float32)
+    misses = []
+    for i, k in enumerate(keys):
+        if k in db:
+            out[i] = db[k]
+        else:
+            misses.append(i)
+    if misses:
+        for i, vec in zip(misses, embed_texts_online([texts[i] for i in misses], dim=dim)):
+            out[i] = vec
+            if vec.any():
+                db[keys[i]] = vec
+    print(f"  Embeddings: {len(texts) - len(misses)} cached, {len(misses)} requested")
+    return out
+
+def normalize_rows(mat):
+    """L2-normalize rows (ontology once at load, queries before search); zero / non-finite rows become zero."""
+    norms = np.linalg.norm(mat, axis=1, keepdims=True)
+    bad = (norms == 0) | ~np.isfinite(norms)
+    norms[bad] = 1.0
+    unit = np.ascontiguousarray(mat / norms, dtype=np.float32)
+    unit[bad[:, 0]] = 0.0
+    return unit
+
+def cosine_similarity_batch(Q, onto_unit):
+    """Similarity of every query row against the pre-normalized ontology in one GEMM → (n_queries, n_onto)."""
+    S = normalize_rows(Q) @ onto_unit.T
     # sanitize any potential numerical noise
-    sims[~np.isfinite(sims)] = 0.0
-    return sims.astype(np.float32)
+    S[~np.isfinite(S)] = 0.0
+    return S.astype(np.float32, copy=False)
+
+def top_k_indices(sims, k):
+    """Indices of the k largest scores along the last axis, best first (O(N) argpartition + sort of only k)."""
+    k = min(k, sims.shape[-1])
+    if k == 0:
+        return np.empty(sims.shape[:-1] + (0,), dtype=np.intp)
+    part = np.argpartition(-sims, k - 1, axis=-1)[..., :k]
+    order = np.argsort(-np.take_along_axis(sims, part, axis=-1), axis=-1)
+    return np.take_along_axis(part, order, axis=-1)
+
+def build_index(onto_unit):
+    """FAISS inner-product index over the unit ontology (= cosine), cached on disk; None without faiss."""
+    if faiss is None:
+        return None
+    n, dim = onto_unit.shape
+    encoding = {None: "Flat", "fp16": "SQfp16", "int8": "SQ8"}[ONTO_QUANT]
+    layout = f"IVF1024,{encoding}" if n >= FAISS_IVF_MIN else encoding
+    # a Flat index is just a copy of onto_unit, cheaper to rebuild than to read back; only layouts
+    # that need training (IVF / SQ) are persisted, and rebuilt when ONTO_VECS is newer
+    index_file = ONTO_INDEX.format(layout.replace(",", "_")) if layout != "Flat" else None
+    if index_file and os.path.exists(index_file) and os.path.getmtime(index_file) >= os.path.getmtime(ONTO_VECS):
+        index = faiss.read_index(index_file)
+    else:
+        index = faiss.index_factory(dim, layout, faiss.METRIC_INNER_PRODUCT)
+        if not index.is_trained:
+            index.train(onto_unit)
+        index.add(onto_unit)
+        if index_file:
+            os.makedirs(CACHE_DIR, exist_ok=True)
+            faiss.write_index(index, index_file)
+    if hasattr(index, "nprobe"):
+        index.nprobe = 32
+    return index
+
+def ontology_to_gpu(onto_unit):
+    """Copy the unit ontology to the GPU once (float16); None without torch or a CUDA/MPS device."""
+    if torch is None:
+        return None
+    if torch.cuda.is_available():
+        device = "cuda"
+    elif getattr(torch.backends, "mps", None) is not None and torch.backends.mps.is_available():
+        device = "mps"
+    else:
+        return None
+    return torch.from_numpy(onto_unit).to(device, dtype=torch.float16)
+
+def search_top_k(Q, onto_unit, k, index=None, onto_gpu=None):
+    """Top-k (scores, ontology indices) per query row, best first — GPU, FAISS or NumPy."""
+    k = min(k, onto_unit.shape[0])
+    if onto_gpu is not None and len(Q):
+        Qg = torch.from_numpy(normalize_rows(Q)).to(onto_gpu.device, dtype=onto_gpu.dtype)
+        D, I = torch.topk(Qg @ onto_gpu.T, k, dim=1)
+        return D.float().cpu().numpy(), I.cpu().numpy()
+    if index is not None and len(Q):
+        return index.search(normalize_rows(Q), k)
+    S = cosine_similarity_batch(Q, onto_unit)
+    I = top_k_indices(S, k)
+    return np.take_along_axis(S, I, axis=-1), I
+
+QUDT_LABELS = {
+    "KiloW": "kW",
+    "KiloN-M": "kNm",
+    "REV-PER-MIN": "rpm",
+    "M3": "m³",
+    "MPa": "MPa",
+    "KiloN": "kN",
+    "HZ": "Hz",
+}
+# KiloN-M must precede KiloN in the alternation
+QUDT_RE = re.compile(r"unit:(KiloW|KiloN-M|REV-PER-MIN|M3|MPa|KiloN|HZ)")
 
 def qudt_uri_to_label(u: str):
     if not u: return ""
     txt = str(u)
-    mapping = {
-        "unit:KiloW": "kW",
-        "unit:KiloN-M": "kNm",
-        "unit:REV-PER-MIN": "rpm",
-        "unit:M3": "m³",
-        "unit:MPa": "MPa",
-        "unit:KiloN": "kN",
-        "unit:HZ": "Hz",
-    }
-    for k, v in mapping.items():
-        if k in txt:
-            return v
-    return txt.split("#")[-1]
+    m = QUDT_RE.search(txt)
+    return QUDT_LABELS[m.group(1)] if m else txt.split("#")[-1]
 
 def reason_best_match(var, query_text, top_matches):
     prompt = f"""
@@ -100,7 +260,7 @@ Variable metadata:
 {query_text}
 
 Candidates:
-{json.dumps(top_matches, indent=2)}
+{orjson.dumps(top_matches, option=orjson.OPT_INDENT_2).decode()}
 
 Guidelines:
 - Expand abbreviations (P→Power, T→Torque, omega/n→RotationalSpeed).
@@ -116,47 +276,107 @@ Return strict JSON ONLY:
 }}
 """
     payload = {
-        "model": "gpt-4.1-2025-04-14",
+        "model": LLM_MODEL,
         "messages": [
             {"role": "system", "content": "Output only valid JSON."},
             {"role": "user", "content": prompt}
         ],
         "temperature": 0.1
     }
-    r = requests.post(LLM_URL, headers=HEADERS, json=payload, timeout=120)
+    r = SESSION.post(LLM_URL, json=payload, timeout=120)
     if r.status_code != 200:
         return {"original": var, "best_match": "", "confidence": 0.0, "reason": f"API {r.status_code}"}
     try:
-        content = r.json()["choices"][0]["message"]["content"]
+        content = orjson.loads(r.content)["choices"][0]["message"]["content"]
         start, end = content.find("{"), content.rfind("}") + 1
-        return json.loads(content[start:end])
+        verdict = orjson.loads(content[start:end])
     except Exception:
-        return {"original": var, "best_match": "", "confidence": 0.0, "reason": "parse error"}
+        verdict = None
+    if is_verdict(verdict):
+        return verdict
+    return {"original": var, "best_match": "", "confidence": 0.0, "reason": "parse error"}
+
+def auto_accept(var, tops):
+    """Clear top-1 (high similarity + margin over top-2) → mapping without an LLM call, else None."""
+    if len(tops) < 2:
+        return None
+    top, second = tops[0]["similarity"], tops[1]["similarity"]
+    if top >= AUTO_ACCEPT_SIM and (top - second) >= SIM_GAP:
+        return {"original": var, "best_match": tops[0]["id"], "confidence": float(min(0.99, top)),
+                "reason": "auto-margin"}
+    return None
+
+def is_verdict(res):
+    """True for a usable LLM verdict: a dict with a best_match string and a numeric confidence."""
+    return (isinstance(res, dict) and isinstance(res.get("best_match"), str)
+            and type(res.get("confidence")) in (int, float))
+
+def reasoning_failed(res):
+    """True for reason_best_match's API / parse-error fallbacks and malformed verdicts (these are not cached)."""
+    if not is_verdict(res):
+        return True
+    reason = str(res.get("reason", ""))
+    return reason.startswith("API ") or reason == "parse error"
 
 # ---------------- PIPELINE STEPS ----------------
+def load_graph_cache(cache_file):
+    """Rebuild (graph, vars) from a cache written by extract_vars (N-Triples parse, no turtle)."""
+    with open(cache_file, "rb") as f:
+        cached = pickle.load(f)
+    g = Graph()
+    for prefix, ns in cached["namespaces"]:
+        g.bind(prefix, ns)
+    g.parse(data=cached["nt"], format="nt")
+    return g, cached["vars"]
+
 def extract_vars(ttl):
+    """Parse `ttl` once and return (graph, vars) so the graph can be reused for renaming.
+    Unchanged files are served from CACHE_DIR instead of re-running the turtle parser."""
+    h = hashlib.sha256(f"extract-v{EXTRACT_VERSION}\n".encode())
+    with open(ttl, "rb") as f:
+        h.update(f.read())
+    key = h.hexdigest()
+    cache_file = os.path.join(CACHE_DIR, f"{key}_vars.pkl")
+    if os.path.exists(cache_file):
+        return load_graph_cache(cache_file)
+
     g = Graph(); g.parse(ttl, format="turtle")
+    # one SPARQL pass instead of seven triples() lookups per subject; later rows win like before
+    found = {}
+    for row in g.query(VARS_QUERY):
+        found.setdefault(row.s, {}).update({k: v for k, v in row.asdict().items() if v is not None})
     vars_out = []
-    for s, _p, _o in g.triples((None, RDF.type, None)):
-        if (s, RDF.type, sosa.ObservableProperty) in g or (s, RDF.type, ssn.Property) in g:
-            rec = {"id": str(s), "name": None, "context": None, "datatype": None, "unit": None, "value": None}
-            for _a, _b, o in g.triples((s, fmu.hasFMUVariableName, None)): rec["name"] = str(o)
-            for _a, _b, o in g.triples((s, ssp.hasVariableName, None)):   rec["name"] = str(o)
-            for _a, _b, o in g.triples((s, ssn.isPropertyOf, None)):      rec["context"] = str(o)
-            for _a, _b, o in g.triples((s, fmu.hasDataType, None)):       rec["datatype"] = str(o)
-            for _a, _b, o in g.triples((s, ssp.hasDataType, None)):       rec["datatype"] = str(o)
-            for _a, _b, o in g.triples((s, qudt.unit, None)):             rec["unit"] = str(o)
-            for obs, _b, _c in g.triples((None, sosa.observedProperty, s)):
-                for _x, _y, val in g.triples((obs, sosa.hasSimpleResult, None)):
-                    try: rec["value"] = float(val)
-                    except: rec["value"] = str(val)
-            vars_out.append(rec)
-    return vars_out
+    for s, fields in found.items():
+        name = fields.get("sspName", fields.get("fmuName"))
+        datatype = fields.get("sspType", fields.get("fmuType"))
+        val = fields.get("val")
+        if val is not None:
+            try: val = float(val)
+            except: val = str(val)
+        vars_out.append({
+            "id": str(s),
+            "name": str(name) if name is not None else None,
+            "context": str(fields["ctx"]) if "ctx" in fields else None,
+            "datatype": str(datatype) if datatype is not None else None,
+            "unit": str(fields["unit"]) if "unit" in fields else None,
+            "value": val,
+        })
+
+    os.makedirs(CACHE_DIR, exist_ok=True)
+    with open(cache_file, "wb") as f:
+        pickle.dump({
+            "vars": vars_out,
+            "namespaces": [(prefix, str(ns)) for prefix, ns in g.namespaces()],
+            "nt": g.serialize(format="nt"),
+        }, f)
+    return g, vars_out
+
+POWER_HINT_RE = re.compile(r"\bp[_\-]?(me|w)?\b")
 
 def build_query(v):
     hints = []
     lname = (v.get("name") or "").lower()
-    if re.search(r"\bp[_\-]?(me|w)?\b", lname) or "power" in lname: hints.append("Likely ENGINE POWER.")
+    if POWER_HINT_RE.search(lname) or "power" in lname: hints.append("Likely ENGINE POWER.")
     if "omega" in lname or "rpm" in lname or "rev" in lname or "nn" in lname: hints.append("Likely ROTATIONAL SPEED.")
     if lname.startswith("t") or "torq" in lname: hints.append("Likely TORQUE.")
     if "bollard" in lname or "thrust" in lname: hints.append("Likely THRUST.")
@@ -173,30 +393,40 @@ def build_query(v):
         f"{hint_txt}"
     )
 
-def rename_with_conf(base, ttl_file, mappings, conf_thresh=CONF_THRESHOLD):
+def rename_with_conf(base, g, mappings, conf_thresh=CONF_THRESHOLD):
+    """Add sameAs + confidence to the already-parsed graph `g` and write it out."""
     out_file = f"{base}_corrected.ttl"
-    g = Graph(); g.parse(ttl_file, format="turtle")
     changes, low_conf = 0, []
+    # variable name → subjects, built once instead of scanning all names per mapping
+    name_to_subjs = {}
+    for subj, _, val in g.triples((None, fmu.hasFMUVariableName, None)):
+        name_to_subjs.setdefault(str(val), []).append(subj)
     for m in mappings:
         orig, best, conf = m.get("original"), m.get("best_match"), float(m.get("confidence", 0.0))
         if not best:
             continue
         if conf < conf_thresh:
             low_conf.append(m); continue
-        for subj, _, val in g.triples((None, fmu.hasFMUVariableName, None)):
-            if str(val) == str(orig):
-                old = subj; new = URIRef(best)
-                g.add((old, owl.sameAs, new))
-                g.add((old, prov.confidence, Literal(conf, datatype=XSD.decimal)))
-                changes += 1
+        for old in name_to_subjs.get(str(orig), ()):
+            g.add((old, owl.sameAs, URIRef(best)))
+            g.add((old, prov.confidence, Literal(conf, datatype=XSD.decimal)))
+            changes += 1
     g.serialize(out_file, format="turtle")
     print(f"  Applied {changes} confident renames → {out_file}")
     if low_conf:
-        with open(f"{base}_LowConfidence.json", "w", encoding="utf-8") as f:
-            json.dump(low_conf, f, indent=2)
+        with open(f"{base}_LowConfidence.json", "wb") as f:
+            f.write(orjson.dumps(low_conf, option=orjson.OPT_INDENT_2))
         print(f"  {len(low_conf)} low-confidence mappings saved for review.")
     return out_file
 
+def combined_flag(conf):
+    """Flag used in combined_predictions.csv → (confidence_flag, needs_human)."""
+    if conf >= 0.7:
+        return "HIGH_CONF", False
+    elif 0.4 <= conf < 0.7:
+        return "LOW_CONF", True
+    return "NO_MATCH", True
+
 # ---------------- MAIN ----------------
 def run_all():
     # auto-discover files if TTL_FILES not specified
@@ -209,61 +439,20 @@ def run_all():
             raise FileNotFoundError("No OEM*_OEM.ttl or Engine_Test1.ttl found in the current folder.")
 
     # ontology
-    onto_vecs = np.load(ONTO_VECS)
-    onto_ids  = json.load(open(ONTO_IDS, "r", encoding="utf-8"))
-    onto_txts = json.load(open(ONTO_TXTS, "r", encoding="utf-8"))
+    onto_vecs = normalize_rows(np.load(ONTO_VECS))
+    with open(ONTO_IDS, "rb") as f:
+        onto_ids = orjson.loads(f.read())
+    with open(ONTO_TXTS, "rb") as f:
+        onto_txts = orjson.loads(f.read())
     dim = onto_vecs.shape[1]
+    onto_gpu = ontology_to_gpu(onto_vecs)
+    onto_index = build_index(onto_vecs) if onto_gpu is None else None
 
-    combined_rows = []  # for combined_predictions.csv
-
-    for ttl in files:
-        base = os.path.splitext(os.path.basename(ttl))[0]
-        print(f"\n================= Processing {ttl} =================")
-        vars_list = extract_vars(ttl)
-        print(f"  Extracted {len(vars_list)} vars")
-
-        # retrieval + reasoning
-        mappings = []
-        for v in vars_list:
-            q = build_query(v)
-            vec = embed_text_online(q, dim=dim)
-            sims = cosine_similarity(vec, onto_vecs)
-            idx = np.argsort(sims)[::-1][:TOP_K]
-            tops = [{"id": onto_ids[i], "similarity": float(sims[i]), "text": onto_txts[i]} for i in idx]
-            res = reason_best_match(v["name"], q, tops)
-            mappings.append(res)
-            print(f"  → {v['name']} → {res['best_match']} (conf={res['confidence']:.2f})")
-            combined_rows.append([base, v["name"], res.get("best_match",""), float(res.get("confidence",0.0)), res.get("reason","")])
-
-        with open(f"{base}_Mappings.json", "w", encoding="utf-8") as f:
-            json.dump(mappings, f, indent=2)
-        print(f"  Saved mappings → {base}_Mappings.json")
-
-        # rename + provenance
-        corrected = rename_with_conf(base, ttl, mappings, conf_thresh=CONF_THRESHOLD)
-
-                # --- confidence-based flagging ---
-        for res in mappings:
-            conf = float(res.get("confidence", 0.0))
-            if not res.get("best_match"):
-                flag = "NO_MATCH"
-                needs_human = True
-            elif conf >= 0.6:
-                flag = "HIGH_CONF"
-                needs_human = False
-            elif 0.4 <= conf < 0.6:
-                flag = "LOW_CONF"
-                needs_human = True
-            else:
-                flag = "NO_MATCH"
-                needs_human = True
-            res["confidence_flag"] = flag
-            res["needs_human"] = needs_human
-
-
-       # combined predictions with flags
-    with open("combined_predictions.csv", "w", newline="", encoding="utf-8") as f:
-        w = csv.writer(f)
+    # combined predictions are streamed row-by-row so a crash keeps completed work
+    os.makedirs(CACHE_DIR, exist_ok=True)
+    with open("combined_predictions.csv", "w", newline="", encoding="utf-8") as csv_f, \
+         shelve.open(EMBED_CACHE) as embed_db, shelve.open(REASON_CACHE) as reason_db:
+        w = csv.writer(csv_f)
         w.writerow([
             "base",
             "original",
@@ -273,18 +462,94 @@ def run_all():
             "needs_human",
             "reason"
         ])
-        for m in combined_rows:
-            # m = [base, original, best_match, conf, reason]
-            base, orig, best, conf, reason = m
-            if conf >= 0.7:
-                flag, need_human = "HIGH_CONF", False
-            elif 0.4 <= conf < 0.7:
-                flag, need_human = "LOW_CONF", True
-            elif not best:
-                flag, need_human = "NO_MATCH", True
-            else:
-                flag, need_human = "NO_MATCH", True
-            w.writerow([base, orig, best, conf, flag, need_human, reason])
+
+        for ttl in files:
+            base = os.path.splitext(os.path.basename(ttl))[0]
+            print(f"\n================= Processing {ttl} =================")
+            g, vars_list = extract_vars(ttl)
+            print(f"  Extracted {len(vars_list)} vars")
+
+            # retrieval + reasoning (each mapping is appended to a .jsonl as soon as it exists)
+            mappings = []
+            map_file, jsonl_file = f"{base}_Mappings.json", f"{base}_Mappings.jsonl"
+
+            # identical query texts (sibling vars with same name/unit/context) are embedded once
+            queries = [build_query(v) for v in vars_list]
+            unique_queries = list(dict.fromkeys(queries))
+            print(f"  {len(unique_queries)} unique queries")
+
+            # retrieval: all unique queries at once (GPU matmul, FAISS index, or one GEMM + argpartition)
+            D, I = search_top_k(embed_texts_cached(unique_queries, embed_db, dim=dim), onto_vecs, TOP_K,
+                                index=onto_index, onto_gpu=onto_gpu)
+            tops_by_query = {}
+            for q, scores, idx in zip(unique_queries, D, I):
+                tops_by_query[q] = [{"id": onto_ids[i], "similarity": float(sc), "text": onto_txts[i]}
+                                    for sc, i in zip(scores, idx) if i >= 0]
+
+            # reasoning: distinct queries (same query → same candidates) run concurrently; results stream in order
+            with ThreadPoolExecutor(max_workers=LLM_CONCURRENCY) as pool, open(jsonl_file, "wb") as jsonl_f:
+                try:
+                    reasoned, pending = {}, {}   # query → result (or Future); query → cache key
+                    for v, q in zip(vars_list, queries):
+                        if q in reasoned:
+                            continue
+                        auto = auto_accept(v["name"], tops_by_query[q])
+                        if auto is not None:
+                            reasoned[q] = auto
+                            continue
+                        key = cache_key(LLM_MODEL, PROMPT_VERSION, v["name"], q, sorted(t["id"] for t in tops_by_query[q]))
+                        if key in reason_db:
+                            reasoned[q] = reason_db[key]
+                        else:
+                            reasoned[q] = pool.submit(reason_best_match, v["name"], q, tops_by_query[q])
+                            pending[q] = key
+                    for v, q in zip(vars_list, queries):
+                        if q in pending:
+                            reasoned[q] = reasoned[q].result()
+                            key = pending.pop(q)
+                            if not reasoning_failed(reasoned[q]):
+                                reason_db[key] = reasoned[q]
+                        res = dict(reasoned[q])
+                        mappings.append(res)
+                        print(f"  → {v['name']} → {res['best_match']} (conf={res['confidence']:.2f})")
+
+                        jsonl_f.write(orjson.dumps(res) + b"\n")
+                        jsonl_f.flush()
+                        best, conf = res.get("best_match", ""), float(res.get("confidence", 0.0))
+                        flag, need_human = combined_flag(conf)
+                        w.writerow([base, v["name"], best, conf, flag, need_human, res.get("reason", "")])
+                        csv_f.flush()
+                except BaseException:
+                    # drop queued LLM calls instead of waiting for them all on Ctrl-C or a failed call
+                    pool.shutdown(cancel_futures=True)
+                    raise
+
+            # consolidate the streamed .jsonl into the usual JSON array
+            with open(map_file, "wb") as f:
+                f.write(orjson.dumps(mappings, option=orjson.OPT_INDENT_2))
+            os.remove(jsonl_file)
+            print(f"  Saved mappings → {map_file}")
+
+            # rename + provenance
+            corrected = rename_with_conf(base, g, mappings, conf_thresh=CONF_THRESHOLD)
+
+                    # --- confidence-based flagging ---
+            for res in mappings:
+                conf = float(res.get("confidence", 0.0))
+                if not res.get("best_match"):
+                    flag = "NO_MATCH"
+                    needs_human = True
+                elif conf >= 0.6:
+                    flag = "HIGH_CONF"
+                    needs_human = False
+                elif 0.4 <= conf < 0.6:
+                    flag = "LOW_CONF"
+                    needs_human = True
+                else:
+                    flag = "NO_MATCH"
+                    needs_human = True
+                res["confidence_flag"] = flag
+                res["needs_human"] = needs_human
 
 
 if __name__ == "__main__":
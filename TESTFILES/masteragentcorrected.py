@@ -4,8 +4,11 @@
 # Adds: unit extraction, OOD gating, abstention, thresholds
 # ===========================================================
 
-import os, re, json, time, glob, csv, requests
+import os, re, time, glob, csv, threading, requests
+from concurrent.futures import ThreadPoolExecutor
+from requests.adapters import HTTPAdapter
 import numpy as np
+import orjson
 from dotenv import load_dotenv
 from rdflib import Graph, Namespace, RDF
 
@@ -17,7 +20,8 @@ if not AALTO_KEY:
 
 TTL_FILES = None            # None = auto-detect all OEM*_OEM.ttl
 TOP_K = 5
-SLEEP_BETWEEN_CALLS = 1.3      # seconds between each variable reasoning call
+EMBED_BATCH = 64               # queries per embeddings request
+LLM_CONCURRENCY = 8            # reasoning calls in flight at once; pacing only kicks in after a 429
 MAX_RETRIES = 2
 BACKOFF = 8                    # seconds backoff on rate limit
 SHOW_ONLY_SUMMARY = True
@@ -28,6 +32,33 @@ EMBED_URL = "https://aalto-openai-apigw.azure-api.net/v1/openai/text-embedding-3
 LLM_URL   = "https://aalto-openai-apigw.azure-api.net/v1/openai/deployments/gpt-4.1-2025-04-14/chat/completions"
 HEADERS   = {"Content-Type": "application/json", "Ocp-Apim-Subscription-Key": AALTO_KEY}
 
+# one pooled keep-alive session for every Aalto call (avoids a TLS handshake per request)
+SESSION = requests.Session()
+SESSION.headers.update(HEADERS)
+SESSION.mount("https://", HTTPAdapter(pool_connections=4, pool_maxsize=16, max_retries=0))
+
+
+class RateLimiter:
+    """Shared 429 gate: calls run back-to-back until the API throttles, then every worker waits out the backoff."""
+
+    def __init__(self, backoff):
+        self.backoff = backoff
+        self.resume_at = 0.0
+        self.lock = threading.Lock()
+
+    def wait(self):
+        with self.lock:
+            delay = self.resume_at - time.monotonic()
+        if delay > 0:
+            time.sleep(delay)
+
+    def throttled(self):
+        with self.lock:
+            self.resume_at = max(self.resume_at, time.monotonic() + self.backoff)
+
+
+LIMITER = RateLimiter(BACKOFF)
+
 # --- ontology store (pre-embedded) ---
 ONTO_VECS = "ontology_vectors.npy"
 ONTO_IDS  = "ontology_ids.json"
@@ -42,35 +73,73 @@ qudt = Namespace("http://qudt.org/2.1/schema/qudt#")
 # UTILITIES
 # ===========================================================
 
-def embed_text_online(text, dim=3072):
-    payload = {"input": text, "model": "text-embedding-3-large"}
+def _embed_request(inputs):
+    """(vectors, None) from one embeddings call over `inputs`, or (None, last HTTP status) once the retries
+    are spent; the status is None when the last attempt never got a response."""
+    status = None
     for attempt in range(1, MAX_RETRIES + 1):
+        LIMITER.wait()
         try:
-            r = requests.post(EMBED_URL, headers=HEADERS, json=payload, timeout=45)
+            r = SESSION.post(EMBED_URL, json={"input": inputs, "model": "text-embedding-3-large"}, timeout=45)
+            status = r.status_code
             if r.status_code == 200:
-                return np.array(r.json()["data"][0]["embedding"], dtype=np.float32)
+                data = sorted(orjson.loads(r.content)["data"], key=lambda d: d["index"])
+                return np.array([d["embedding"] for d in data], dtype=np.float32), None
             elif r.status_code == 429:
-                print(f"⚠️  Rate limit hit, sleeping {BACKOFF}s (attempt {attempt})")
-                time.sleep(BACKOFF)
+                print(f"⚠️  Rate limit hit, backing off {BACKOFF}s (attempt {attempt})")
+                LIMITER.throttled()
                 continue
             else:
-                print(f"Embedding API error ({r.status_code}) — fallback to zero vector.")
+                print(f"Embedding API error ({r.status_code}) — retrying.")
         except requests.exceptions.RequestException:
+            status = None
             print(f"Network issue (attempt {attempt}) — retrying…")
             time.sleep(5)
-    return np.zeros(dim, dtype=np.float32)
-
-
-def cosine_similarity(vec, mat):
-    denom = np.linalg.norm(vec)
-    if (denom == 0) or (not np.isfinite(denom)):
-        return np.zeros(mat.shape[0], dtype=np.float32)
-    v = vec / denom
-    Mnorms = np.linalg.norm(mat, axis=1, keepdims=True)
-    M = np.divide(mat, Mnorms, out=np.zeros_like(mat), where=(Mnorms != 0))
-    sims = np.dot(M, v)
-    sims[~np.isfinite(sims)] = 0.0
-    return sims
+    return None, status
+
+
+def embed_texts_online(texts, dim=3072, batch=EMBED_BATCH):
+    """Embed a list of texts, `batch` inputs per request. A batch the API keeps rejecting is retried one
+    text at a time, so one bad input cannot blank its neighbours; zero vectors for what still fails."""
+    out = np.zeros((len(texts), dim), dtype=np.float32)
+    for start in range(0, len(texts), batch):
+        chunk = texts[start:start + batch]
+        vecs, status = _embed_request(chunk)
+        if vecs is not None:
+            out[start:start + len(chunk)] = vecs
+        elif status not in (None, 429) and len(chunk) > 1:
+            print(f"Embedding batch failed ({status}) — retrying its {len(chunk)} texts one by one.")
+            for i, text in enumerate(chunk):
+                vec, _ = _embed_request([text])
+                if vec is not None:
+                    out[start + i] = vec[0]
+    return out
+
+
+def normalize_rows(mat):
+    """L2-normalize rows (ontology once at load, queries per batch); zero / non-finite rows become zero."""
+    norms = np.linalg.norm(mat, axis=1, keepdims=True)
+    bad = (norms == 0) | ~np.isfinite(norms)
+    norms[bad] = 1.0
+    unit = np.ascontiguousarray(mat / norms, dtype=np.float32)
+    unit[bad[:, 0]] = 0.0
+    return unit
+
+def cosine_similarity_batch(Q, onto_unit):
+    """Similarity of every query row against the pre-normalized ontology in one GEMM → (n_queries, n_onto)."""
+    S = normalize_rows(Q) @ onto_unit.T
+    # sanitize any potential numerical noise
+    S[~np.isfinite(S)] = 0.0
+    return S.astype(np.float32, copy=False)
+
+
+def top_k_indices(sims, k):
+    """Indices of the k largest scores, best first (O(N) argpartition + sort of only k)."""
+    k = min(k, sims.shape[0])
+    if k == 0:
+        return np.empty(0, dtype=np.intp)
+    part = np.argpartition(-sims, k - 1)[:k]
+    return part[np.argsort(-sims[part])]
 
 
 def reason_best_match(var, query_text, top_matches):
@@ -81,7 +150,7 @@ Variable metadata:
 {query_text}
 
 Candidates:
-{json.dumps(top_matches, indent=2)}
+{orjson.dumps(top_matches, option=orjson.OPT_INDENT_2).decode()}
 
 Guidelines:
 - Expand abbreviations (P→Power, T→Torque, n/omega→RotationalSpeed, EAR→Expanded Area Ratio).
@@ -97,7 +166,8 @@ Return strict JSON ONLY:
 }}
 """
     for attempt in range(1, MAX_RETRIES + 1):
-        r = requests.post(LLM_URL, headers=HEADERS, json={
+        LIMITER.wait()
+        r = SESSION.post(LLM_URL, json={
             "model": "gpt-4.1-2025-04-14",
             "messages": [
                 {"role": "system", "content": "Output only valid JSON."},
@@ -107,16 +177,16 @@ Return strict JSON ONLY:
         }, timeout=120)
 
         if r.status_code == 429:
-            print(f"⚠️  Hit rate limit — sleeping {BACKOFF}s (attempt {attempt})")
-            time.sleep(BACKOFF)
+            print(f"⚠️  Hit rate limit — backing off {BACKOFF}s (attempt {attempt})")
+            LIMITER.throttled()
             continue
         elif r.status_code != 200:
             return {"original": var, "best_match": "", "confidence": 0.0, "reason": f"API {r.status_code}"}
 
         try:
-            content = r.json()["choices"][0]["message"]["content"]
+            content = orjson.loads(r.content)["choices"][0]["message"]["content"]
             start, end = content.find("{"), content.rfind("}") + 1
-            return json.loads(content[start:end])
+            return orjson.loads(content[start:end])
         except Exception:
             return {"original": var, "best_match": "", "confidence": 0.0, "reason": "parse error"}
     return {"original": var, "best_match": "", "confidence": 0.0, "reason": "max retries"}
@@ -132,6 +202,7 @@ OOD_PATTERNS = [
     r"\bPkt", r"\bPLC", r"\bFW[_-]", r"\bDbgVar",
     r"\bMemTemp", r"\bCabTemp", r"\bChecksum", r"\bVibAlarm"
 ]
+OOD_RE = re.compile("|".join(OOD_PATTERNS), re.IGNORECASE)   # one pass over the name
 
 UNIT_EQUIV = {
     "rpm": {"REV-PER-MIN", "RPM"},
@@ -192,7 +263,7 @@ def unit_compat_score(orig: str, cand: str) -> float:
 def is_ood(name: str) -> bool:
     if not name:
         return False
-    return any(re.search(p, name, re.IGNORECASE) for p in OOD_PATTERNS)
+    return OOD_RE.search(name) is not None
 
 
 # ===========================================================
@@ -201,106 +272,128 @@ def is_ood(name: str) -> bool:
 
 def run_eval():
     files = TTL_FILES if TTL_FILES else sorted(glob.glob("OEM*_OEM.ttl"))
-    onto_vecs = np.load(ONTO_VECS)
-    onto_ids  = json.load(open(ONTO_IDS))
-    onto_txts = json.load(open(ONTO_TXTS))
+    onto_vecs = normalize_rows(np.load(ONTO_VECS))
+    with open(ONTO_IDS, "rb") as f:
+        onto_ids = orjson.loads(f.read())
+    with open(ONTO_TXTS, "rb") as f:
+        onto_txts = orjson.loads(f.read())
     dim = onto_vecs.shape[1]
 
     results = []
-
-    for ttl in files:
-        base = os.path.splitext(os.path.basename(ttl))[0]
-        print(f"\n================= Processing {ttl} =================")
-        g = Graph(); g.parse(ttl, format="turtle")
-
-        vars_list = []
-        for s,_,_ in g.triples((None, RDF.type, sosa.ObservableProperty)):
-            name = None
-            for _,_,o in g.triples((s, fmu.hasFMUVariableName, None)):
-                name = str(o)
-            u_val = ""
-            for _,_,u in g.triples((s, qudt.unit, None)):
-                u_val = str(u)
-            unit_tok = normalize_unit_token(u_val) or infer_unit_from_varname(name)
-            vars_list.append({"id": str(s), "name": name, "unit": unit_tok})
-        print(f"  Extracted {len(vars_list)} vars")
-
-        # loop variables
-        for v in vars_list:
-            # --- OOD keyword rejection ---
-            if is_ood(v["name"]):
-                results.append({
+    sim_cache = {}   # query string -> similarity row; identical queries are embedded once per run
+    pool = ThreadPoolExecutor(max_workers=LLM_CONCURRENCY)
+
+    # on Ctrl-C or a failed call, drop the queued LLM requests instead of waiting for all of them
+    try:
+        for ttl in files:
+            base = os.path.splitext(os.path.basename(ttl))[0]
+            print(f"\n================= Processing {ttl} =================")
+            g = Graph(); g.parse(ttl, format="turtle")
+
+            vars_list = []
+            for s,_,_ in g.triples((None, RDF.type, sosa.ObservableProperty)):
+                name = None
+                for _,_,o in g.triples((s, fmu.hasFMUVariableName, None)):
+                    name = str(o)
+                u_val = ""
+                for _,_,u in g.triples((s, qudt.unit, None)):
+                    u_val = str(u)
+                unit_tok = normalize_unit_token(u_val) or infer_unit_from_varname(name)
+                vars_list.append({"id": str(s), "name": name, "unit": unit_tok})
+            print(f"  Extracted {len(vars_list)} vars")
+
+            # build every query up front so embeddings go out in batched requests
+            queries = []
+            for v in vars_list:
+                query = f"Variable '{v['name']}' from OEM dataset"
+                if v["unit"]:
+                    query += f" [unit={v['unit']}]"
+                queries.append(query)
+            unique = list(dict.fromkeys(q for q, v in zip(queries, vars_list) if not is_ood(v["name"])))
+            new = [q for q in unique if q not in sim_cache]
+            if new:
+                # one GEMM for the file's unseen queries; repeats (in this file or earlier ones) reuse their row
+                sim_cache.update(zip(new, cosine_similarity_batch(embed_texts_online(new, dim), onto_vecs)))
+            print(f"  Embedded {len(new)} new / {len(unique)} unique queries")
+
+            # loop variables; ambiguous ones are sent to the LLM pool and resolved after the loop
+            pending = []
+            for vi, v in enumerate(vars_list):
+                # --- OOD keyword rejection ---
+                if is_ood(v["name"]):
+                    results.append({
+                        "file": base,
+                        "original_name": v["name"],
+                        "best_match": "",
+                        "confidence": 0.0,
+                        "reason": "Rejected by OOD keyword gate"
+                    })
+                    print(f"  → {v['name']} → (no match) [OOD]")
+                    continue
+
+                query = queries[vi]
+                sims = sim_cache[query]
+
+                # adjust by unit compatibility
+                adj_sims = []
+                for i, sim in enumerate(sims):
+                    cu = unit_from_candidate_id(onto_ids[i])
+                    w = unit_compat_score(v["unit"], cu)
+                    adj_sims.append(sim * w)
+                adj_sims = np.array(adj_sims)
+                top_idx = top_k_indices(adj_sims, TOP_K)
+                top_adj = adj_sims[top_idx]
+                tops = [{"id": onto_ids[i], "similarity": float(top_adj[j]), "text": onto_txts[i]} for j,i in enumerate(top_idx)]
+
+                # low-sim abstain
+                if len(top_adj)==0 or top_adj[0] < MIN_SIM:
+                    results.append({
+                        "file": base,
+                        "original_name": v["name"],
+                        "best_match": "",
+                        "confidence": 0.0,
+                        "reason": f"Low similarity ({top_adj[0] if len(top_adj) else 0:.2f} < {MIN_SIM})"
+                    })
+                    print(f"  → {v['name']} → (no match) [low-sim]")
+                    continue
+
+                # strong top gap -> auto-pick
+                if len(top_adj) >= 2 and (top_adj[0] - top_adj[1]) >= SIM_GAP:
+                    top_id = tops[0]["id"]
+                    conf = float(min(0.99, max(0.5, top_adj[0])))
+                    results.append({
+                        "file": base,
+                        "original_name": v["name"],
+                        "best_match": top_id,
+                        "confidence": conf,
+                        "reason": "Auto-picked by adjusted similarity margin"
+                    })
+                    print(f"  → {v['name']} → {top_id} (conf={conf:.2f}) [auto]")
+                    continue
+
+                # ambiguous case → ask LLM (slot in results is filled once the call returns)
+                pending.append((len(results), v, pool.submit(reason_best_match, v["name"], query, tops)))
+                results.append(None)
+
+            for slot, v, fut in pending:
+                res = fut.result()
+                cu = unit_from_candidate_id(res.get("best_match",""))
+                if res.get("best_match") and unit_compat_score(v["unit"], cu) < 0.7:
+                    res = {"original": v["name"], "best_match": "", "confidence": 0.0,
+                           "reason": "Abstained: incompatible units"}
+
+                results[slot] = {
                     "file": base,
                     "original_name": v["name"],
-                    "best_match": "",
-                    "confidence": 0.0,
-                    "reason": "Rejected by OOD keyword gate"
-                })
-                print(f"  → {v['name']} → (no match) [OOD]")
-                continue
-
-            query = f"Variable '{v['name']}' from OEM dataset"
-            if v["unit"]:
-                query += f" [unit={v['unit']}]"
-
-            vec = embed_text_online(query, dim)
-            sims = cosine_similarity(vec, onto_vecs)
-
-            # adjust by unit compatibility
-            adj_sims = []
-            for i, sim in enumerate(sims):
-                cu = unit_from_candidate_id(onto_ids[i])
-                w = unit_compat_score(v["unit"], cu)
-                adj_sims.append(sim * w)
-            adj_sims = np.array(adj_sims)
-            idx = np.argsort(adj_sims)[::-1]
-            top_idx = idx[:TOP_K]
-            top_adj = adj_sims[top_idx]
-            tops = [{"id": onto_ids[i], "similarity": float(top_adj[j]), "text": onto_txts[i]} for j,i in enumerate(top_idx)]
-
-            # low-sim abstain
-            if len(top_adj)==0 or top_adj[0] < MIN_SIM:
-                results.append({
-                    "file": base,
-                    "original_name": v["name"],
-                    "best_match": "",
-                    "confidence": 0.0,
-                    "reason": f"Low similarity ({top_adj[0] if len(top_adj) else 0:.2f} < {MIN_SIM})"
-                })
-                print(f"  → {v['name']} → (no match) [low-sim]")
-                continue
-
-            # strong top gap -> auto-pick
-            if len(top_adj) >= 2 and (top_adj[0] - top_adj[1]) >= SIM_GAP:
-                top_id = tops[0]["id"]
-                conf = float(min(0.99, max(0.5, top_adj[0])))
-                results.append({
-                    "file": base,
-                    "original_name": v["name"],
-                    "best_match": top_id,
-                    "confidence": conf,
-                    "reason": "Auto-picked by adjusted similarity margin"
-                })
-                print(f"  → {v['name']} → {top_id} (conf={conf:.2f}) [auto]")
-                time.sleep(SLEEP_BETWEEN_CALLS)
-                continue
-
-            # ambiguous case → ask LLM
-            res = reason_best_match(v["name"], query, tops)
-            cu = unit_from_candidate_id(res.get("best_match",""))
-            if res.get("best_match") and unit_compat_score(v["unit"], cu) < 0.7:
-                res = {"original": v["name"], "best_match": "", "confidence": 0.0,
-                       "reason": "Abstained: incompatible units"}
-
-            results.append({
-                "file": base,
-                "original_name": v["name"],
-                "best_match": res.get("best_match",""),
-                "confidence": float(res.get("confidence", 0.0)),
-                "reason": res.get("reason","")
-            })
-            print(f"  → {v['name']} → {res.get('best_match','')} (conf={float(res.get('confidence',0.0)):.2f})")
-            time.sleep(SLEEP_BETWEEN_CALLS)
+                    "best_match": res.get("best_match",""),
+                    "confidence": float(res.get("confidence", 0.0)),
+                    "reason": res.get("reason","")
+                }
+                print(f"  → {v['name']} → {res.get('best_match','')} (conf={float(res.get('confidence',0.0)):.2f})")
+    except BaseException:
+        pool.shutdown(cancel_futures=True)
+        raise
+    pool.shutdown()
 
     # write results
     with open("eval_results.csv", "w", newline="", encoding="utf-8") as f:
@@ -322,7 +415,7 @@ def run_eval():
 
     print("\nExample outputs:")
     for r in results[:5]:
-        print(json.dumps(r, indent=2))
+        print(orjson.dumps(r, option=orjson.OPT_INDENT_2).decode())
 
 
 # ===========================================================
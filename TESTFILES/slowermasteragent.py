@@ -3,11 +3,15 @@
 # Extract → Retrieve → Reason → Print results only
 # ===========================================================
 
-import os, re, json, time, glob
+import os, re, time, glob, random, hashlib, pickle, shelve, threading
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
 import numpy as np
+import orjson
 import requests
+from requests.adapters import HTTPAdapter
 from dotenv import load_dotenv
-from rdflib import Graph, Namespace, RDF
+from rdflib import Graph, Namespace
+from rdflib.plugins.sparql import prepareQuery
 import csv
 
 # ---------------- CONFIG ----------------
@@ -18,74 +22,227 @@ if not AALTO_KEY:
 
 TTL_FILES = None               # None = auto-detect all OEM*_OEM.ttl
 TOP_K = 5
-SLEEP_BETWEEN_CALLS = 1.3      # seconds between each variable reasoning call
+LLM_CONCURRENCY = 8            # reasoning calls in flight at once (replaces the fixed per-call sleep)
+LLM_RPM = 45                   # chat requests per minute allowed by the token bucket (gateway quota)
+EMBED_BATCH = 64               # queries per embeddings request
 MAX_RETRIES = 2
-BACKOFF = 8                   # seconds backoff on rate limit
+BACKOFF = 8                   # base seconds of (exponential, jittered) backoff on rate limit
+CAND_TEXT_CHARS = 200          # candidate description sent to the LLM (after the id label), clamped to this
 SHOW_ONLY_SUMMARY = True       # prints summary at end
 SHACL_RULES = None
 
 # --- Aalto API endpoints ---
 EMBED_URL = "https://aalto-openai-apigw.azure-api.net/v1/openai/text-embedding-3-large/embeddings"
 LLM_URL   = "https://aalto-openai-apigw.azure-api.net/v1/openai/deployments/gpt-4.1-2025-04-14/chat/completions"
+LLM_MODEL   = "gpt-4.1-2025-04-14"
+PROMPT_VERSION = 2             # bump whenever SYSTEM_PROMPT, the user prompt or the candidate format changes
 HEADERS   = {"Content-Type": "application/json", "Ocp-Apim-Subscription-Key": AALTO_KEY}
 
+# one pooled keep-alive session for every Aalto call (avoids a TLS handshake per request)
+SESSION = requests.Session()
+SESSION.headers.update(HEADERS)
+SESSION.mount("https://", HTTPAdapter(pool_connections=4, pool_maxsize=16, max_retries=0))
+
+
+class TokenBucket:
+    """Thread-safe pacing: refills `rpm` tokens per minute, bursts up to `rpm`; acquire() blocks only when empty."""
+
+    def __init__(self, rpm):
+        self.rate = rpm / 60.0
+        self.capacity = float(rpm)
+        self.tokens = float(rpm)
+        self.ts = time.monotonic()
+        self.lock = threading.Lock()
+
+    def acquire(self):
+        while True:
+            with self.lock:
+                now = time.monotonic()
+                self.tokens = min(self.capacity, self.tokens + (now - self.ts) * self.rate)
+                self.ts = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                wait = (1 - self.tokens) / self.rate
+            time.sleep(wait)
+
+
+LLM_BUCKET = TokenBucket(LLM_RPM)
+
 # --- ontology store (pre-embedded) ---
 ONTO_VECS = "ontology_vectors.npy"
 ONTO_IDS  = "ontology_ids.json"
 ONTO_TXTS = "ontology_texts.json"
 
+# --- persistent caches (safe to delete) ---
+CACHE_DIR = ".cache"
+EMBED_CACHE = os.path.join(CACHE_DIR, "embed_eval")   # shelve: sha256(model + text) → vector
+REASON_CACHE = os.path.join(CACHE_DIR, "reason_eval") # shelve: blake2b(model, prompt version, name, candidate ids) → LLM verdict
+ONTO_UNIT = os.path.join(CACHE_DIR, "ontology_unit.npy")      # unit-normalized rows, float32
+ONTO_META = os.path.join(CACHE_DIR, "ontology_meta.pkl")      # (onto_ids, onto_txts) in one pickle
+
 # --- namespaces ---
 sosa = Namespace("http://www.w3.org/ns/sosa/")
 fmu  = Namespace("http://example.com/fmu#")
 ssn  = Namespace("http://www.w3.org/ns/ssn/")
 
+# one indexed pass per file instead of a triples() scan per ObservableProperty
+VARS_QUERY = prepareQuery("""
+SELECT ?s ?n WHERE {
+  ?s a sosa:ObservableProperty .
+  OPTIONAL { ?s fmu:hasFMUVariableName ?n }
+}""", initNs={"sosa": sosa, "fmu": fmu})
+
 # ---------------- UTILITIES ----------------
-def embed_text_online(text, dim=3072):
-    payload = {"input": text, "model": "text-embedding-3-large"}
+def _embed_request(inputs):
+    """(vectors, None) from one embeddings call over `inputs`, or (None, last HTTP status) once the retries
+    are spent; the status is None when the last attempt never got a response."""
+    status = None
     for attempt in range(1, MAX_RETRIES + 1):
         try:
-            r = requests.post(EMBED_URL, headers=HEADERS, json=payload, timeout=45)
+            r = SESSION.post(EMBED_URL, json={"input": inputs, "model": "text-embedding-3-large"}, timeout=45)
+            status = r.status_code
             if r.status_code == 200:
-                data = r.json()["data"][0]["embedding"]
-                return np.array(data, dtype=np.float32)
+                data = sorted(orjson.loads(r.content)["data"], key=lambda d: d["index"])
+                return np.array([d["embedding"] for d in data], dtype=np.float32), None
             elif r.status_code == 429:
                 print(f"⚠️  Rate limit hit, sleeping {BACKOFF}s (attempt {attempt})")
                 time.sleep(BACKOFF)
                 continue
             else:
-                print(f"Embedding API error ({r.status_code}) — using zero-vector fallback.")
+                print(f"Embedding API error ({r.status_code}) — retrying.")
         except requests.exceptions.RequestException:
+            status = None
             print(f"Network issue (attempt {attempt}). Retrying...")
             time.sleep(5)
-    return np.zeros(dim, dtype=np.float32)
+    return None, status
 
 
-def cosine_similarity(vec, mat):
-    denom = np.linalg.norm(vec)
-    if (denom == 0) or (not np.isfinite(denom)):
-        return np.zeros(mat.shape[0], dtype=np.float32)
-    v = vec / denom
-    Mnorms = np.linalg.norm(mat, axis=1, keepdims=True)
-    M = np.divide(mat, Mnorms, out=np.zeros_like(mat), where=(Mnorms != 0))
-    sims = np.dot(M, v)
-    sims[~np.isfinite(sims)] = 0.0
-    return sims
+def embed_texts_online(texts, dim=3072, batch=EMBED_BATCH):
+    """Embed a list of texts, `batch` inputs per request. A batch the API keeps rejecting is retried one
+    text at a time, so one bad input cannot blank its neighbours; zero vectors for what still fails."""
+    out = np.zeros((len(texts), dim), dtype=np.float32)
+    for start in range(0, len(texts), batch):
+        chunk = texts[start:start + batch]
+        vecs, status = _embed_request(chunk)
+        if vecs is not None:
+            out[start:start + len(chunk)] = vecs
+        elif status not in (None, 429) and len(chunk) > 1:
+            print(f"Embedding batch failed ({status}) — retrying its {len(chunk)} texts one by one.")
+            for i, text in enumerate(chunk):
+                vec, _ = _embed_request([text])
+                if vec is not None:
+                    out[start + i] = vec[0]
+    return out
 
 
-def reason_best_match(var, query_text, top_matches):
-    prompt = f"""
-You are a reasoning agent mapping OEM variables to ontology concepts.
+def embed_texts_cached(texts, db, dim=3072):
+    """embed_texts_online behind the persistent cache `db`; zero-vector fallbacks are never stored."""
+    keys = [hashlib.sha256(f"text-embedding-3-large\n{t}".encode("utf-8")).hexdigest() for t in texts]
+    out = np.zeros((len(texts), dim), dtype=np.float32)
+    misses = []
+    for i, k in enumerate(keys):
+        if k in db:
+            out[i] = db[k]
+        else:
+            misses.append(i)
+    if misses:
+        for i, vec in zip(misses, embed_texts_online([texts[i] for i in misses], dim=dim)):
+            out[i] = vec
+            if vec.any():
+                db[keys[i]] = vec
+    print(f"  Embeddings: {len(texts) - len(misses)} cached, {len(misses)} requested")
+    return out
 
-Variable metadata:
-{query_text}
 
-Candidates:
-{json.dumps(top_matches, indent=2)}
+def normalize_rows(mat):
+    """L2-normalize rows (ontology once at load, queries per batch); zero / non-finite rows become zero."""
+    norms = np.linalg.norm(mat, axis=1, keepdims=True)
+    bad = (norms == 0) | ~np.isfinite(norms)
+    norms[bad] = 1.0
+    unit = np.ascontiguousarray(mat / norms, dtype=np.float32)
+    unit[bad[:, 0]] = 0.0
+    return unit
+
+
+def cosine_similarity_batch(Q, onto_unit):
+    """Similarity of every query row against the pre-normalized ontology in one GEMM → (n_queries, n_onto)."""
+    S = normalize_rows(Q) @ onto_unit.T
+    S[~np.isfinite(S)] = 0.0
+    return S
+
+
+def load_ontology():
+    """(unit ontology float32, ids, texts) from the packed store; repacked when the sources are newer."""
+    sources, packed = [ONTO_VECS, ONTO_IDS, ONTO_TXTS], [ONTO_UNIT, ONTO_META]
+    if not all(os.path.exists(p) for p in packed) or \
+            min(map(os.path.getmtime, packed)) < max(map(os.path.getmtime, sources)):
+        os.makedirs(CACHE_DIR, exist_ok=True)
+        np.save(ONTO_UNIT, normalize_rows(np.load(ONTO_VECS)))
+        with open(ONTO_IDS, "rb") as f:
+            onto_ids = orjson.loads(f.read())
+        with open(ONTO_TXTS, "rb") as f:
+            onto_txts = orjson.loads(f.read())
+        with open(ONTO_META, "wb") as f:
+            pickle.dump((onto_ids, onto_txts), f, protocol=pickle.HIGHEST_PROTOCOL)
+        print(f"  Packed ontology store → {ONTO_UNIT}")
+    with open(ONTO_META, "rb") as f:
+        onto_ids, onto_txts = pickle.load(f)
+    # rows are stored already normalized in full float32 precision: no per-run normalization pass.
+    # BLAS reads the matrix in place only if it is C-contiguous float32 (else numpy copies per call);
+    # ascontiguousarray is a no-op for a store written by this function and fixes up anything else
+    return np.ascontiguousarray(np.load(ONTO_UNIT), dtype=np.float32), onto_ids, onto_txts
 
+
+def top_k_indices(sims, k):
+    """Indices of the k largest scores along the last axis, best first (O(N) argpartition + sort of only k)."""
+    k = min(k, sims.shape[-1])
+    if k == 0:
+        return np.empty(sims.shape[:-1] + (0,), dtype=np.intp)
+    part = np.argpartition(-sims, k - 1, axis=-1)[..., :k]
+    order = np.argsort(-np.take_along_axis(sims, part, axis=-1), axis=-1)
+    return np.take_along_axis(part, order, axis=-1)
+
+
+def topk_cosine(Q, onto_unit, k, block=256):
+    """Top-k (scores, ontology indices) per query row, best first.
+    Scores `block` queries per GEMM and keeps only their top-k, so the full similarity matrix never exists."""
+    k = min(k, onto_unit.shape[0])
+    D = np.empty((Q.shape[0], k), dtype=np.float32)
+    I = np.empty((Q.shape[0], k), dtype=np.intp)
+    for start in range(0, Q.shape[0], block):
+        S = cosine_similarity_batch(Q[start:start + block], onto_unit)
+        idx = top_k_indices(S, k)
+        I[start:start + block] = idx
+        D[start:start + block] = np.take_along_axis(S, idx, axis=-1)
+    return D, I
+
+
+# fixed instructions live in the system prompt (identical prefix on every call)
+SYSTEM_PROMPT = """You are a reasoning agent mapping OEM variables to ontology concepts.
 Guidelines:
 - Expand abbreviations (P→Power, T→Torque, omega/n→RotationalSpeed).
 - Choose exactly one candidate ID matching meaning + unit + domain.
 - If none clearly match, leave best_match empty and confidence 0.0.
+Output only valid JSON."""
+
+# fallback for replies that wrap the verdict in prose: the last {...} block (one nesting level)
+_JSON_RE = re.compile(r"\{[^{}]*(?:\{[^{}]*\}[^{}]*)*\}", re.S)
+
+# every ontology text opens with "Entity ID: <id>." — the id is already sent separately
+_ENTITY_PREFIX_RE = re.compile(r"^Entity ID:\s*\S+?\.(?:\s+|$)")
+
+
+def reason_best_match(var, query_text, top_matches):
+    # the LLM only needs id + a short description; scores and long texts just cost tokens
+    compact = [{"id": m["id"], "text": _ENTITY_PREFIX_RE.sub("", m["text"], count=1)[:CAND_TEXT_CHARS]}
+               for m in top_matches]
+    prompt = f"""
+Variable metadata:
+{query_text}
+
+Candidates:
+{orjson.dumps(compact).decode()}
 
 Return strict JSON ONLY:
 {{
@@ -96,84 +253,144 @@ Return strict JSON ONLY:
 }}
 """
     for attempt in range(1, MAX_RETRIES + 1):
-        r = requests.post(LLM_URL, headers=HEADERS, json={
-            "model": "gpt-4.1-2025-04-14",
+        LLM_BUCKET.acquire()
+        r = SESSION.post(LLM_URL, json={
+            "model": LLM_MODEL,
             "messages": [
-                {"role": "system", "content": "Output only valid JSON."},
+                {"role": "system", "content": SYSTEM_PROMPT},
                 {"role": "user", "content": prompt}
             ],
-            "temperature": 0.1
+            "temperature": 0.1,
+            "response_format": {"type": "json_object"}
         }, timeout=120)
 
         if r.status_code == 429:
-            print(f"⚠️  Hit rate limit — sleeping {BACKOFF}s (attempt {attempt})")
-            time.sleep(BACKOFF)
+            delay = BACKOFF * 2 ** (attempt - 1) + random.uniform(0, 1)
+            print(f"⚠️  Hit rate limit — sleeping {delay:.1f}s (attempt {attempt})")
+            time.sleep(delay)
             continue
         elif r.status_code != 200:
             return {"original": var, "best_match": "", "confidence": 0.0, "reason": f"API {r.status_code}"}
 
         try:
-            content = r.json()["choices"][0]["message"]["content"]
-            start, end = content.find("{"), content.rfind("}") + 1
-            return json.loads(content[start:end])
+            content = orjson.loads(r.content)["choices"][0]["message"]["content"]
+            try:
+                verdict = orjson.loads(content)
+            except orjson.JSONDecodeError:
+                verdict = orjson.loads(_JSON_RE.findall(content)[-1])
         except Exception:
-            return {"original": var, "best_match": "", "confidence": 0.0, "reason": "parse error"}
+            verdict = None
+        if is_verdict(verdict):
+            return verdict
+        return {"original": var, "best_match": "", "confidence": 0.0, "reason": "parse error"}
 
     return {"original": var, "best_match": "", "confidence": 0.0, "reason": "max retries exceeded"}
 
 
+def reason_key(var, top_matches):
+    """Reasoning-cache key: model + prompt version + case-folded variable name + the (unordered) candidate id set."""
+    ids = sorted(m["id"] for m in top_matches)
+    return hashlib.blake2b(orjson.dumps([LLM_MODEL, PROMPT_VERSION, (var or "").lower().strip(), ids])).hexdigest()
+
+
+def is_verdict(res):
+    """True for a usable LLM verdict: a dict with a best_match string and a numeric confidence."""
+    return (isinstance(res, dict) and isinstance(res.get("best_match"), str)
+            and type(res.get("confidence")) in (int, float))
+
+
+def reasoning_failed(res):
+    """True for the error fallbacks of reason_best_match and malformed verdicts (never cached)."""
+    if not is_verdict(res):
+        return True
+    reason = str(res.get("reason", ""))
+    return reason.startswith("API ") or reason in ("parse error", "max retries exceeded")
+
+
+def extract_vars(ttl):
+    """Parse one OEM TTL → (file base name, [{id, name}]); top-level so a process pool can run it."""
+    g = Graph(); g.parse(ttl, format="turtle")
+    names = {}   # subject → name (None when the property has no FMU name)
+    for row in g.query(VARS_QUERY):
+        if row.n is not None or row.s not in names:
+            names[row.s] = str(row.n) if row.n is not None else None
+    base = os.path.splitext(os.path.basename(ttl))[0]
+    return base, [{"id": str(s), "name": n} for s, n in names.items()]
+
+
 # ---------------- MAIN ----------------
 def run_eval():
     files = TTL_FILES if TTL_FILES else sorted(glob.glob("OEM*_OEM.ttl"))
-    onto_vecs = np.load(ONTO_VECS)
-    onto_ids  = json.load(open(ONTO_IDS))
-    onto_txts = json.load(open(ONTO_TXTS))
+    onto_vecs, onto_ids, onto_txts = load_ontology()   # unit rows once; similarity is then a plain matmul
     dim = onto_vecs.shape[1]
 
-    results = []
+    # extract every file first so a name shared across OEMs is embedded and reasoned once
+    # (rdflib's turtle parser is pure Python and holds the GIL, so files are parsed in separate processes)
+    if len(files) > 1:
+        with ProcessPoolExecutor() as ex:
+            per_file = list(ex.map(extract_vars, files))
+    else:
+        per_file = [extract_vars(ttl) for ttl in files]
 
-    for ttl in files:
-        base = os.path.splitext(os.path.basename(ttl))[0]
+    all_vars = []
+    for ttl, (base, vars_list) in zip(files, per_file):
         print(f"\n================= Processing {ttl} =================")
-        g = Graph(); g.parse(ttl, format="turtle")
+        print(f"  Extracted {len(vars_list)} vars")
+        all_vars.extend({"file": base, **v} for v in vars_list)
+
+    results = []
+    os.makedirs(CACHE_DIR, exist_ok=True)
+    # rows stream as they resolve (one writer for the whole run, not a rewrite per file);
+    # the pool is entered last so it is shut down before the caches and CSV are closed
+    with shelve.open(EMBED_CACHE) as embed_db, shelve.open(REASON_CACHE) as reason_db, \
+         open("eval_results.csv", "w", newline="", encoding="utf-8") as csv_f, \
+         ThreadPoolExecutor(max_workers=LLM_CONCURRENCY) as pool:
+        writer = csv.DictWriter(csv_f, fieldnames=["file","original_name","best_match","confidence","reason"])
+        writer.writeheader()
+        try:
+            # embed every unique query up front, EMBED_BATCH per request
+            unique = list(dict.fromkeys(v["name"] for v in all_vars))
+            queries = [f"Variable '{n}' from OEM dataset" for n in unique]
+            print(f"\n  {len(unique)} unique names across {len(all_vars)} variables")
+            D, I = topk_cosine(embed_texts_cached(queries, embed_db, dim), onto_vecs, TOP_K)
 
-        vars_list = []
-        for s,_,_ in g.triples((None, RDF.type, sosa.ObservableProperty)):
-            name = None
-            for _,_,o in g.triples((s, fmu.hasFMUVariableName, None)):
-                name = str(o)
-            vars_list.append({"id": str(s), "name": name})
+            # submit each uncached (name, candidates) pair once
+            key_of, submitted = {}, {}
+            for name, query, scores, idx in zip(unique, queries, D, I):
+                tops = [{"id": onto_ids[i], "similarity": float(sc), "text": onto_txts[i]}
+                        for sc, i in zip(scores, idx)]
+                key = key_of[name] = reason_key(name, tops)
+                if key not in reason_db and key not in submitted:
+                    submitted[key] = pool.submit(reason_best_match, name, query, tops)
+            print(f"  Reasoning: {len(unique) - len(submitted)} cached, {len(submitted)} requested")
 
-        print(f"  Extracted {len(vars_list)} vars")
+            # fan verdicts back out to every occurrence, in file / variable order
+            for v in all_vars:
+                key = key_of[v["name"]]
+                if key in submitted:
+                    res = submitted[key].result()
+                    if not reasoning_failed(res):
+                        reason_db[key] = res
+                else:
+                    res = reason_db[key]
+
+                # ⬇️ include the file/base NOW
+                results.append({
+                    "file": v["file"],             # e.g., OEMA_OEM
+                    "original_name": v["name"],
+                    "best_match": res.get("best_match",""),
+                    "confidence": float(res.get("confidence", 0.0)),
+                    "reason": res.get("reason","")
+                })
+                writer.writerow(results[-1])
+                csv_f.flush()
 
-        # inside run_eval(), when iterating variables:
-        for v in vars_list:
-            query = f"Variable '{v['name']}' from OEM dataset"
-            vec = embed_text_online(query, dim)
-            sims = cosine_similarity(vec, onto_vecs)
-            idx = np.argsort(sims)[::-1][:TOP_K]
-            tops = [{"id": onto_ids[i], "similarity": float(sims[i]), "text": onto_txts[i]} for i in idx]
-            res = reason_best_match(v["name"], query, tops)
-
-            # ⬇️ include the file/base NOW
-            results.append({
-                "file": base,                  # e.g., OEMA_OEM
-                "original_name": v["name"],
-                "best_match": res.get("best_match",""),
-                "confidence": float(res.get("confidence", 0.0)),
-                "reason": res.get("reason","")
-            })
-
-            print(f"  → {v['name']} → {res['best_match']} (conf={res['confidence']:.2f})")
-            time.sleep(SLEEP_BETWEEN_CALLS)
-
-        # then write CSV exactly from results:
-        with open("eval_results.csv", "w", newline="", encoding="utf-8") as f:
-            import csv
-            w = csv.DictWriter(f, fieldnames=["file","original_name","best_match","confidence","reason"])
-            w.writeheader()
-            w.writerows(results)
-        print("✅ Saved results → eval_results.csv")
+                print(f"  → [{v['file']}] {v['name']} → {res['best_match']} (conf={res['confidence']:.2f})")
+        except BaseException:
+            # drop queued LLM calls instead of waiting for them all on Ctrl-C or a failed call
+            pool.shutdown(cancel_futures=True)
+            raise
+    print("✅ Saved results → eval_results.csv")
     print("\n📊 === SUMMARY ===")
     total = len(results)
     high = sum(1 for r in results if r["confidence"] >= 0.7)
@@ -186,7 +403,7 @@ def run_eval():
 
     print("\nExample outputs:")
     for r in results[:5]:
-        print(json.dumps(r, indent=2))
+        print(orjson.dumps(r, option=orjson.OPT_INDENT_2).decode())
 
 
 if __name__ == "__main__":
@@ -6,6 +6,8 @@ import os
 import time
 import json
 import subprocess
+import threading
+from collections import deque
 
 # ---------------- PAGE CONFIG ----------------
 st.set_page_config(
@@ -42,6 +44,8 @@ with col2:
 # Paths
 WORK_DIR = os.path.dirname(os.path.abspath(__file__))
 TTL_SAVE_PATH = os.path.join(WORK_DIR, "uploaded.ttl")
+LOG_TAIL = 500        # lines kept on screen while the pipeline runs
+LOG_REFRESH = 0.2     # seconds between live log re-renders
 
 # ---------------- RESET HANDLER ----------------
 if reset_button:
@@ -61,20 +65,35 @@ if run_button and uploaded_ttl:
     st.info("Running Master Agent pipeline... this may take several minutes.")
     start_time = time.time()
 
+    # -u: the child otherwise block-buffers its piped stdout and lines would arrive in bursts
     process = subprocess.Popen(
-        ["python", "masteragent.py"],
+        ["python", "-u", "masteragent.py"],
         stdout=subprocess.PIPE,
         stderr=subprocess.STDOUT,
         cwd=WORK_DIR,
         text=True
     )
 
+    # full log is kept for the session; a reader thread drains the pipe while the page re-renders
+    # the bounded tail every LOG_REFRESH s, whether or not a new line has arrived
     log_container = st.empty()
-    logs = ""
-    for line in process.stdout:
-        logs += line
-        log_container.text(logs)
+    lines, tail, lock = [], deque(maxlen=LOG_TAIL), threading.Lock()
+
+    def read_output():
+        for line in process.stdout:
+            with lock:
+                lines.append(line)
+                tail.append(line)
+
+    reader = threading.Thread(target=read_output, daemon=True)
+    reader.start()
+    while reader.is_alive():
+        reader.join(LOG_REFRESH)
+        with lock:
+            shown = "".join(tail)
+        log_container.text(shown)
     process.wait()
+    logs = "".join(lines)
 
     elapsed = time.time() - start_time
     st.session_state.logs = logs
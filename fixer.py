@@ -1,7 +1,13 @@
 #!/usr/bin/env python3
+import os
+import re
 import json
 import sys
-from copy import deepcopy
+import multiprocessing
+from collections import deque
+from functools import partial
+from types import MappingProxyType
+import orjson
 
 ID_MAP = {
     "PropulsionSystem": "prop:PropulsionSystem",
@@ -41,52 +47,201 @@ KEY_MAP = {
     "prop:hasMember": "hasMember",
 }
 
-def transform(obj):
-    if isinstance(obj, dict):
-        newd = {}
-        for k, v in obj.items():
-            k2 = KEY_MAP.get(k, k)
-
-            if k2 == "@id" and isinstance(v, str) and v in ID_MAP:
-                v2 = ID_MAP[v]
-            elif k2 == "@type" and isinstance(v, str) and v in ID_MAP:
-                v2 = ID_MAP[v]
-            else:
-                v2 = transform(v)
-
-            newd[k2] = v2
-        return newd
-
-    if isinstance(obj, list):
-        return [transform(x) for x in obj]
-
-    # Optional: also map *string values* in graph that exactly match the bad IDs.
-    if isinstance(obj, str) and obj in ID_MAP:
-        return ID_MAP[obj]
-
-    return obj
+# Both tables are static: expose them read-only, but look up through the plain dicts' bound .get
+# (a mappingproxy adds a call layer to every lookup)
+_ID_LOOKUP, ID_MAP = ID_MAP.get, MappingProxyType(ID_MAP)
+_KEY_LOOKUP, KEY_MAP = KEY_MAP.get, MappingProxyType(KEY_MAP)
+
+def transform(obj, _id_get=_ID_LOOKUP, _key_get=_KEY_LOOKUP, _intern=sys.intern, _type=type,
+              _dict=dict, _list=list, _str=str):
+    """Return a remapped copy of `obj`. Iterative (explicit work queue) so deep graphs cost no
+    Python call frame per node and cannot hit the recursion limit. The keyword defaults bind the
+    hot globals / builtins as locals once; callers never pass them. Exact `type(x) is` checks are
+    enough because parsed JSON only yields plain dict / list / str."""
+    out = [None]
+    todo = deque([(out, 0, obj)])   # (new parent container, key / index, original value)
+    push, pop = todo.append, todo.popleft
+    while todo:
+        parent, slot, v = pop()
+        t = _type(v)
+        if t is _dict:
+            newd = parent[slot] = {}
+            for k, x in v.items():
+                k2 = _intern(_key_get(k, k))   # one shared str per distinct key across the output
+                tx = _type(x)
+                # @id / @type and, optionally, any other *string value* that exactly matches a bad ID:
+                # one hash lookup, no separate `in` test
+                if tx is _str:
+                    newd[k2] = _id_get(x, x)
+                elif tx is _dict or tx is _list:
+                    newd[k2] = None   # placeholder keeps key order; filled when popped
+                    push((newd, k2, x))
+                else:
+                    newd[k2] = x
+        elif t is _list:
+            newl = parent[slot] = [None] * len(v)
+            for i, x in enumerate(v):
+                tx = _type(x)
+                if tx is _str:
+                    newl[i] = _id_get(x, x)
+                elif tx is _dict or tx is _list:
+                    push((newl, i, x))
+                else:
+                    newl[i] = x
+        elif t is _str:
+            parent[slot] = _id_get(v, v)
+        else:
+            parent[slot] = v
+    return out[0]
+
+# orjson differs from the stdlib json on a few literals: integers beyond 64 bits (read as float, then
+# refused on write), NaN / Infinity (rejected) and floats it prints without the exponent sign / padding
+# (1e+20 -> 1e20, 1e-07 -> 1e-7; also big or tiny values written without an exponent). Any input that
+# may hold one of those is read and written with the stdlib json instead, exactly like json.load / dump.
+_STDLIB_RE = re.compile(rb"\d{17,}|0\.0000|NaN|Infinity|\d[eE][-+]?\d")
+
+def _orjson_dumps(value):
+    return orjson.dumps(value, option=orjson.OPT_INDENT_2)
+
+def _stdlib_dumps(value):
+    return json.dumps(value, ensure_ascii=False, indent=2).encode()
+
+def _codec(raw):
+    """(loads, dumps) for the document `raw`: orjson, or the stdlib json when orjson could change a value."""
+    if _STDLIB_RE.search(raw):
+        return json.loads, _stdlib_dumps
+    return orjson.loads, _orjson_dumps
+
+def _indented(value, level, dumps=_orjson_dumps):
+    """Indent-2 JSON bytes of `value` as it appears nested `level` levels deep."""
+    return dumps(value).replace(b"\n", b"\n" + b"  " * level)
+
+PARALLEL_MIN_NODES = 1000   # @graph size above which nodes are fixed in a process pool
+
+def _fixed_node(node, dumps=_orjson_dumps):
+    """One @graph member, transformed and serialized as it sits inside the @graph array."""
+    return _indented(transform(node), 2, dumps)
+
+def _fixed_nodes(graph, dumps=_orjson_dumps):
+    """_fixed_node over @graph in order; farmed out to worker processes for large graphs."""
+    fix = partial(_fixed_node, dumps=dumps)
+    cpus = os.cpu_count() or 1
+    if cpus == 1 or len(graph) <= PARALLEL_MIN_NODES:
+        # one core: pickling nodes to a worker and back only adds work
+        yield from map(fix, graph)
+        return
+    chunk = max(1, len(graph) // (4 * cpus))
+    with multiprocessing.Pool() as pool:
+        yield from pool.imap(fix, graph, chunksize=chunk)
+
+def write_streaming(data, f, dumps=_orjson_dumps):
+    """Write `data` as indent-2 JSON to binary file `f`, transforming and emitting @graph one node
+    at a time so the fixed graph is never held in memory as a whole."""
+    f.write(b"{")
+    for i, (k, v) in enumerate(data.items()):
+        f.write((b"," if i else b"") + b"\n  " + dumps(k) + b": ")
+        if k == "@graph" and isinstance(v, list) and v:
+            f.write(b"[")
+            for j, node in enumerate(_fixed_nodes(v, dumps)):
+                f.write((b"," if j else b"") + b"\n    " + node)
+            f.write(b"\n  ]")
+        elif k == "@graph":
+            f.write(_indented(transform(v), 1, dumps))
+        else:
+            f.write(_indented(v, 1, dumps))
+    f.write(b"\n}" if data else b"}")
+
+# ---------------- --text mode: byte-level pass over the raw file ----------------
+# A bad ID as a whole JSON string *value* (not preceded by an escape, not followed by ':');
+# key renames only where the string is followed by ':'.
+_ID_BYTES = {k.encode(): v.encode() for k, v in ID_MAP.items()}
+_KEY_BYTES = {k.encode(): v.encode() for k, v in KEY_MAP.items()}
+_ID_ALT = b"|".join(map(re.escape, _ID_BYTES))
+_ID_RE = re.compile(rb'(?<!\\)"(' + _ID_ALT + rb')"(?!\s*:)')
+_KEY_RE = re.compile(rb'(?<!\\)"(' + b"|".join(map(re.escape, _KEY_BYTES)) + rb')"(?=\s*:)')
+_GRAPH_RE = re.compile(rb'"@graph"\s*:\s*')
+_TOKEN_RE = re.compile(rb'"(?:[^"\\]|\\.)*"|[{}\[\]]', re.S)   # whole strings and brackets
+_SCALAR_RE = re.compile(rb'[^,}\]\s]*')
+# quoted bad IDs in a spot a blind replace would corrupt (after an escape, or used as a key)
+_UNSAFE_RE = re.compile(rb'\\"(?:' + _ID_ALT + rb')"|"(?:' + _ID_ALT + rb')"\s*:')
+_ID_PAIRS = [(b'"' + k + b'"', b'"' + v + b'"') for k, v in _ID_BYTES.items()]
+
+def _graph_span(raw):
+    """(start, end) of the value of the top-level object's @graph key, (0, 0) if there is none;
+    a nested "@graph" (e.g. inside a node) is not the document graph and is skipped."""
+    depth, tokens = 0, _TOKEN_RE.finditer(raw)
+    for t in tokens:
+        c = raw[t.start()]
+        if c == 0x22:                                 # a string; a key when followed by ':'
+            m = _GRAPH_RE.match(raw, t.start()) if depth == 1 else None
+            if m is None:
+                continue
+            start = m.end()
+            if raw[start:start + 1] not in (b"{", b"["):
+                # string / scalar value: ends with its own token
+                return start, (next(tokens).end() if raw[start:start + 1] == b'"'
+                               else _SCALAR_RE.match(raw, start).end())
+            for t in tokens:                          # object / array value: ends at the matching bracket
+                c = raw[t.start()]
+                if c in (0x7B, 0x5B):
+                    depth += 1
+                elif c in (0x7D, 0x5D):
+                    depth -= 1
+                    if depth == 1:
+                        return start, t.end()
+            return start, len(raw)
+        depth += 1 if c in (0x7B, 0x5B) else -1       # { [  /  } ]
+    return 0, 0
+
+def fix_text(raw):
+    """Remap bad IDs / keys inside the top-level @graph without parsing, like tree mode; everything
+    else (@context, other top-level keys) and the formatting are kept as is."""
+    def sub(b):
+        if _UNSAFE_RE.search(b) is None:
+            # every quoted bad ID is a plain value: chain of C-level bytes.replace (memmem), no callbacks
+            for old, new in _ID_PAIRS:
+                b = b.replace(old, new)
+        else:
+            b = _ID_RE.sub(lambda m: b'"' + _ID_BYTES[m.group(1)] + b'"', b)
+        return _KEY_RE.sub(lambda m: b'"' + _KEY_BYTES[m.group(1)] + b'"', b)
+    start, end = _graph_span(raw)
+    return raw[:start] + sub(raw[start:end]) + raw[end:]
 
 def main():
-    if len(sys.argv) != 3:
-        print("Usage: python fix_jsonld_ids.py input.jsonld output.jsonld")
+    args = sys.argv[1:]
+    text_mode = "--text" in args
+    args = [a for a in args if a != "--text"]
+    if len(args) != 2:
+        print("Usage: python fix_jsonld_ids.py [--text] input.jsonld output.jsonld")
         sys.exit(1)
 
-    inp, outp = sys.argv[1], sys.argv[2]
-    with open(inp, "r", encoding="utf-8") as f:
-        data = json.load(f)
-
-    fixed = deepcopy(data)
-
-    # ✅ Do NOT touch @context
-    if "@graph" in fixed:
-        fixed["@graph"] = transform(fixed["@graph"])
-    else:
+    inp, outp = args
+    with open(inp, "rb") as f:
+        raw = f.read()
+
+    if text_mode:
+        # byte-level pass: no rebuild; keeps the input's own formatting. The input is still parsed once
+        # so malformed JSON (comments, trailing commas) fails here exactly as in tree mode
+        data = _codec(raw)[0](raw)
+        if not isinstance(data, dict) or "@graph" not in data:
+            print("⚠️ No @graph found; not modifying anything.")
+            sys.exit(2)
+        with open(outp, "wb") as f:
+            f.write(fix_text(raw))
+        print(f"✅ Wrote fixed JSON-LD to: {outp}")
+        return
+
+    loads, dumps = _codec(raw)
+    data = loads(raw)
+
+    # ✅ Do NOT touch @context (only @graph is transformed, node by node while writing)
+    if "@graph" not in data:
         # fallback: if graph is absent, do nothing instead of risking context edits
         print("⚠️ No @graph found; not modifying anything.")
         sys.exit(2)
 
-    with open(outp, "w", encoding="utf-8") as f:
-        json.dump(fixed, f, ensure_ascii=False, indent=2)
+    with open(outp, "wb") as f:
+        write_streaming(data, f, dumps)
 
     print(f"✅ Wrote fixed JSON-LD to: {outp}")
 
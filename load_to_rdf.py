@@ -1,20 +1,86 @@
+import os
+import json
+from itertools import islice
 from rdflib import Graph
+from rdflib.util import guess_format
+
+try:
+    import pyoxigraph as ox  # optional: Rust JSON-LD parser + native triple store
+except ImportError:
+    ox = None
+try:
+    import oxrdflib  # noqa: F401  optional: registers rdflib's native "Oxigraph" store plugin
+    RDFLIB_STORE = "Oxigraph"
+except ImportError:
+    RDFLIB_STORE = "default"   # rdflib's pure-Python in-memory store
 
 # Path to your ontology JSON-LD
 ONTOLOGY_FILE = "ONTOLOGY_FINAL_fixed.jsonld"
+# Export target; the format follows the extension (".nt" = fast line-by-line N-Triples, ".ttl" = pretty Turtle)
+EXPORT_FILE = "ONTOLOGY_FINAL.ttl"
+# rdflib path only: N-Triples copy of the parsed graph, reused while newer than ONTOLOGY_FILE
+PARSE_CACHE = os.path.join(".cache", "ONTOLOGY_FINAL.nt")
+# prefix bindings of the parsed graph (N-Triples has none), re-bound so cached runs export the same Turtle
+PARSE_PREFIXES = os.path.join(".cache", "ONTOLOGY_FINAL.prefixes.json")
+
+# pyoxigraph reads JSON-LD from 0.5 on (RdfFormat.JSON_LD); older builds fall back to rdflib
+store = None
+if ox is not None and getattr(getattr(ox, "RdfFormat", None), "JSON_LD", None) is not None:
+    # Create a native store and bulk-load the JSON-LD into it
+    store = ox.Store()
+    try:
+        store.bulk_load(path=ONTOLOGY_FILE, format=ox.RdfFormat.JSON_LD)
+    except SyntaxError as e:
+        # pyoxigraph's parser is stricter than rdflib's (e.g. it rejects "@type": {"@id": ...})
+        print(f" (pyoxigraph could not parse {ONTOLOGY_FILE}: {e}; falling back to rdflib)")
+        store = None
+
+if store is not None:
+    print(f" Loaded {len(store)} RDF triples from {ONTOLOGY_FILE}\n")
+
+    # Show a few triples
+    for q in islice(store, 10):
+        print(q.subject, q.predicate, q.object)
 
-# Create an RDF graph
-g = Graph()
+    # Optionally export for inspection (native streaming writer)
+    store.dump(output=EXPORT_FILE, format=ox.RdfFormat.from_extension(EXPORT_FILE.rsplit(".", 1)[-1]),
+               from_graph=ox.DefaultGraph())
+else:
+    # Create an RDF graph (Oxigraph-backed store when oxrdflib is installed)
+    g = Graph(store=RDFLIB_STORE)
 
-# Parse JSON-LD into RDF triples
-g.parse(ONTOLOGY_FILE, format="json-ld")
+    # Parse JSON-LD into RDF triples (or the N-Triples cache, an order of magnitude faster to read)
+    cached = [PARSE_CACHE, PARSE_PREFIXES]
+    if all(os.path.exists(p) for p in cached) and \
+            min(map(os.path.getmtime, cached)) >= os.path.getmtime(ONTOLOGY_FILE):
+        g.parse(PARSE_CACHE, format="nt")
+        with open(PARSE_PREFIXES, encoding="utf-8") as f:
+            for prefix, ns in json.load(f):
+                g.bind(prefix, ns, override=True, replace=True)
+    else:
+        g.parse(ONTOLOGY_FILE, format="json-ld")
+        # write to temp files and publish them only once complete, so a failed dump never leaves a
+        # truncated cache that looks newer than the source; the prefixes go first, the triples last
+        os.makedirs(os.path.dirname(PARSE_CACHE), exist_ok=True)
+        tmp_prefixes, tmp = PARSE_PREFIXES + ".tmp", PARSE_CACHE + ".tmp"
+        try:
+            with open(tmp_prefixes, "w", encoding="utf-8") as f:
+                json.dump([(prefix, str(ns)) for prefix, ns in g.namespaces()], f)
+            os.replace(tmp_prefixes, PARSE_PREFIXES)
+            g.serialize(destination=tmp, format="nt")
+            os.replace(tmp, PARSE_CACHE)
+        except Exception as e:
+            for path in (tmp_prefixes, tmp):
+                if os.path.exists(path):
+                    os.remove(path)
+            print(f" (N-Triples cache not written: {e})")
 
-print(f" Loaded {len(g)} RDF triples from {ONTOLOGY_FILE}\n")
+    print(f" Loaded {len(g)} RDF triples from {ONTOLOGY_FILE}\n")
 
-# Show a few triples
-for s, p, o in list(g)[:10]:
-    print(s, p, o)
+    # Show a few triples
+    for s, p, o in islice(g, 10):
+        print(s, p, o)
 
-# Optionally export to TTL for inspection
-g.serialize(destination="ONTOLOGY_FINAL.ttl", format="turtle")
-print("\n Saved RDF triples to ONTOLOGY_RDF.ttl")
+    # Optionally export for inspection
+    g.serialize(destination=EXPORT_FILE, format=guess_format(EXPORT_FILE))
+print(f"\n Saved RDF triples to {EXPORT_FILE}")